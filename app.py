@@ -1,11 +1,15 @@
 import streamlit as st
-import random
+import logging
 import os
+import contextlib
+import re
+import mimetypes
 import tempfile
-import shutil
-from datetime import datetime, timedelta
-import json
-import threading
+import secrets
+import time
+import sqlite3
+
+logger = logging.getLogger(__name__)
 
 # Configure page
 st.set_page_config(
@@ -14,122 +18,226 @@ st.set_page_config(
     layout="wide"
 )
 
-# Global file to store PIN-to-file mappings
+# Directory holding uploaded files and the PIN metadata database
 STORAGE_DIR = os.path.join(tempfile.gettempdir(), "streamlit_file_transfer")
-METADATA_FILE = os.path.join(STORAGE_DIR, "file_metadata.json")
+DATABASE_FILE = os.path.join(STORAGE_DIR, "meta.db")
+FILE_TTL_SECONDS = 24 * 60 * 60
+CLEANUP_INTERVAL_SECONDS = 60
+CLEANUP_THREAD_NAME = "file-cleanup"
+# Refuse new uploads once 80% of the 9000 four-digit PINs are in use
+MAX_ACTIVE_PINS = 7200
+# ASCII digits only; str.isdigit() would also accept other Unicode digits
+PIN_PATTERN = re.compile(r"[0-9]{4}\Z")
+ADMIN_PAGE_SIZE = 20
+
+@st.cache_resource
+def get_db():
+    """Create the storage directory and open the shared metadata database once per process
+
+    Returns the connection together with the lock that serializes its use across
+    session threads and the cleanup thread.
+    """
+    import threading
+    
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            pin TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            filepath TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            upload_time REAL NOT NULL,
+            type TEXT
+        )
+        """
+    )
+    # Lets the expiry DELETE and the admin view's ORDER BY use a range scan
+    conn.execute("CREATE INDEX IF NOT EXISTS files_upload_time ON files (upload_time)")
+    return conn, threading.Lock()
 
-# Create storage directory if it doesn't exist
-os.makedirs(STORAGE_DIR, exist_ok=True)
+def db_execute(sql, params=()):
+    """Run one statement on the shared connection; returns (rows, rowcount)"""
+    conn, lock = get_db()
+    # rowcount reflects the connection's last change, so read it under the same lock
+    with lock:
+        cursor = conn.execute(sql, params)
+        return cursor.fetchall(), cursor.rowcount
 
-# Thread lock for file operations
-file_lock = threading.Lock()
+def count_active_transfers():
+    """Number of active PINs"""
+    rows, _ = db_execute("SELECT COUNT(*) FROM files")
+    return rows[0][0]
 
-def load_file_metadata():
-    """Load file metadata from persistent storage"""
+def load_file_metadata(limit=-1, offset=0):
+    """Load metadata for active PINs, oldest first, optionally one page at a time"""
     try:
-        if os.path.exists(METADATA_FILE):
-            with open(METADATA_FILE, 'r') as f:
-                data = json.load(f)
-                # Convert string timestamps back to datetime objects
-                for pin, info in data.items():
-                    if isinstance(info['upload_time'], str):
-                        info['upload_time'] = datetime.fromisoformat(info['upload_time'])
-                return data
-        return {}
+        rows, _ = db_execute(
+            "SELECT * FROM files ORDER BY upload_time LIMIT ? OFFSET ?", (limit, offset)
+        )
+        return {row['pin']: dict(row) for row in rows}
     except Exception as e:
         st.error(f"Error loading metadata: {e}")
         return {}
 
-def save_file_metadata(metadata):
-    """Save file metadata to persistent storage"""
-    try:
-        with file_lock:
-            # Convert datetime objects to strings for JSON serialization
-            serializable_data = {}
-            for pin, info in metadata.items():
-                serializable_info = info.copy()
-                if isinstance(serializable_info['upload_time'], datetime):
-                    serializable_info['upload_time'] = serializable_info['upload_time'].isoformat()
-                serializable_data[pin] = serializable_info
-            
-            with open(METADATA_FILE, 'w') as f:
-                json.dump(serializable_data, f, indent=2)
-    except Exception as e:
-        st.error(f"Error saving metadata: {e}")
+def claim_pin(pin, info):
+    """Atomically record metadata for a PIN; returns False if the PIN is taken"""
+    _, rowcount = db_execute(
+        "INSERT OR IGNORE INTO files (pin, filename, filepath, size, upload_time, type) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (pin, info['filename'], info['filepath'], info['size'],
+         info['upload_time'], info['type'])
+    )
+    return rowcount == 1
+
+def delete_pin_metadata(pin):
+    """Remove the metadata for a single PIN"""
+    db_execute("DELETE FROM files WHERE pin = ?", (pin,))
 
 def generate_pin():
-    """Generate a random 4-digit PIN"""
-    metadata = load_file_metadata()
-    while True:
-        pin = f"{random.randint(1000, 9999)}"
-        if pin not in metadata:  # Ensure PIN is unique
-            return pin
+    """Generate a random 4-digit PIN candidate"""
+    if count_active_transfers() > MAX_ACTIVE_PINS:
+        raise RuntimeError("PIN space exhausted, please try again later")
+    return f"{secrets.randbelow(9000) + 1000}"
 
-def save_file_with_pin(uploaded_file, pin):
-    """Save uploaded file with PIN as identifier"""
+def save_file_with_pin(uploaded_file):
+    """Save the uploaded file and reserve a unique PIN for it"""
     try:
-        # Save file with PIN as filename prefix
-        file_path = os.path.join(STORAGE_DIR, f"{pin}_{uploaded_file.name}")
-        
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getvalue())
-        
-        # Load existing metadata
-        metadata = load_file_metadata()
-        
-        # Add new file info
-        metadata[pin] = {
-            'filename': uploaded_file.name,
-            'filepath': file_path,
-            'size': uploaded_file.size,
-            'upload_time': datetime.now(),
-            'type': uploaded_file.type
-        }
+        # Cheap per upload, and recreates the directory if the temp dir was reaped
+        os.makedirs(STORAGE_DIR, exist_ok=True)
         
-        # Save updated metadata
-        save_file_metadata(metadata)
+        # Write straight from the upload's buffer (getbuffer() is a zero-copy view)
+        # before claiming a PIN, so a claimed PIN never points at a missing file
+        tmp_path = os.path.join(STORAGE_DIR, f"{secrets.token_hex(8)}.part")
+        try:
+            with open(tmp_path, "wb") as f, uploaded_file.getbuffer() as buf:
+                f.write(buf)
+            
+            # Claim the PIN in the database so uniqueness is enforced atomically
+            while True:
+                pin = generate_pin()
+                # Save file with PIN as filename prefix
+                file_path = os.path.join(STORAGE_DIR, f"{pin}_{uploaded_file.name}")
+                if claim_pin(pin, {
+                    'filename': uploaded_file.name,
+                    'filepath': file_path,
+                    'size': uploaded_file.size,
+                    'upload_time': time.time(),
+                    'type': uploaded_file.type
+                }):
+                    break
+            
+            try:
+                os.replace(tmp_path, file_path)
+            except Exception:
+                delete_pin_metadata(pin)
+                raise
+        except Exception:
+            # Don't let a failed (e.g. disk full) upload hold its space until the sweep
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
         
-        return file_path
+        return pin, file_path
     except Exception as e:
         raise Exception(f"Failed to save file: {str(e)}")
 
 def get_file_by_pin(pin):
     """Retrieve file information by PIN"""
-    metadata = load_file_metadata()
-    return metadata.get(pin)
+    # Enforce expiry here too; the background sweep only runs periodically
+    rows, _ = db_execute(
+        "SELECT * FROM files WHERE pin = ? AND upload_time >= ?",
+        (pin, time.time() - FILE_TTL_SECONDS)
+    )
+    return dict(rows[0]) if rows else None
 
 def cleanup_old_files():
     """Clean up files older than 24 hours"""
     try:
-        metadata = load_file_metadata()
-        current_time = datetime.now()
-        pins_to_remove = []
+        get_db()  # Ensures the storage directory exists before scanning
+        cutoff = time.time() - FILE_TTL_SECONDS
+        removed = 0
         
-        for pin, file_info in metadata.items():
-            if current_time - file_info['upload_time'] > timedelta(hours=24):
-                # Remove file from disk
-                if os.path.exists(file_info['filepath']):
-                    try:
-                        os.remove(file_info['filepath'])
-                    except OSError:
-                        pass  # File might already be deleted
-                pins_to_remove.append(pin)
-        
-        # Remove expired entries from metadata
-        for pin in pins_to_remove:
-            del metadata[pin]
+        # Expire uploaded files by stat alone; the database is not a regular upload
+        with os.scandir(STORAGE_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(os.path.basename(DATABASE_FILE)):
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except OSError:
+                    pass  # File might already be deleted
         
-        # Save updated metadata
-        if pins_to_remove:
-            save_file_metadata(metadata)
-            
-        return len(pins_to_remove)
-    except Exception as e:
-        st.error(f"Error during cleanup: {e}")
+        db_execute(
+            "DELETE FROM files WHERE upload_time < ?",
+            (cutoff,)
+        )
+        return removed
+    except Exception:
+        # Runs on the cleanup thread, which has no Streamlit context to show errors in
+        logger.exception("Error during cleanup")
         return 0
 
-# Clean up old files on app start
-cleanup_old_files()
+@st.cache_resource
+def how_it_works_markdown():
+    """Static "How it Works" content, built once per process"""
+    senders = """
+### 🚀 For Senders
+1. **Upload**: Select and upload your file
+2. **Generate**: Click to generate a secure 4-digit PIN
+3. **Share**: Send the PIN to your recipient
+4. **Secure**: File expires automatically in 24 hours
+
+### 🔒 Security Features
+- Random 4-digit PIN generation
+- 24-hour automatic expiration
+- Persistent secure file storage
+- Automatic cleanup of expired files
+- Unique PIN guarantee
+"""
+    recipients = """
+### 📱 For Recipients
+1. **Receive**: Get the 4-digit PIN from sender
+2. **Enter**: Input PIN in the Download tab
+3. **Verify**: System verifies PIN and shows file info
+4. **Download**: Click to download the file
+
+### ⚠️ Important Notes
+- Files expire after 24 hours
+- PINs are 4-digit numbers only
+- Keep PINs confidential and secure
+- Files are stored temporarily and auto-cleaned
+- Each PIN is unique and cannot be reused
+"""
+    return senders, recipients
+
+def _cleanup_loop():
+    """Periodically sweep expired files"""
+    while True:
+        cleanup_old_files()
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+
+@st.cache_resource
+def start_cleanup_thread():
+    """Start the background cleanup thread once per process"""
+    import threading
+    
+    # "Clear cache" also clears cache_resource, so check for a running sweeper first
+    for thread in threading.enumerate():
+        if thread.name == CLEANUP_THREAD_NAME:
+            return thread
+    thread = threading.Thread(target=_cleanup_loop, name=CLEANUP_THREAD_NAME, daemon=True)
+    thread.start()
+    return thread
+
+# Clean up old files in the background instead of on every rerun
+start_cleanup_thread()
 
 # App title and description
 st.title("🔒 Secure File Transfer")
@@ -162,8 +270,7 @@ with tab1:
         if st.button("🔐 Generate PIN & Upload", type="primary", use_container_width=True):
             with st.spinner("Uploading file and generating PIN..."):
                 try:
-                    pin = generate_pin()
-                    file_path = save_file_with_pin(uploaded_file, pin)
+                    pin, file_path = save_file_with_pin(uploaded_file)
                     
                     # Success message with PIN
                     st.success("File uploaded successfully!")
@@ -202,18 +309,24 @@ with tab2:
     st.header("Download File")
     st.markdown("Enter the 4-digit PIN to download the shared file")
     
-    # PIN input
+    # PIN input; the form only reruns the script on submit, not on every keystroke
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        pin_input = st.text_input(
-            "Enter 4-digit PIN",
-            max_chars=4,
-            placeholder="1234",
-            help="Enter the PIN provided by the file sender"
-        )
+        with st.form("pin_form"):
+            entered_pin = st.text_input(
+                "Enter 4-digit PIN",
+                max_chars=4,
+                placeholder="1234",
+                help="Enter the PIN provided by the file sender"
+            )
+            if st.form_submit_button("🔍 Verify PIN", use_container_width=True):
+                st.session_state['pin_input'] = entered_pin
+    
+    # Keep the verified PIN across reruns, e.g. the one triggered by the download button
+    pin_input = st.session_state.get('pin_input', "")
     
     if pin_input:
-        if len(pin_input) == 4 and pin_input.isdigit():
+        if PIN_PATTERN.match(pin_input):
             with st.spinner("Verifying PIN..."):
                 file_info = get_file_by_pin(pin_input)
                 
@@ -231,23 +344,33 @@ with tab2:
                         with col3:
                             st.metric("File Type", file_info['type'] or "Unknown")
                         with col4:
-                            time_remaining = 24 - int((datetime.now() - file_info['upload_time']).total_seconds() / 3600)
+                            time_remaining = 24 - int((time.time() - file_info['upload_time']) / 3600)
                             st.metric("Expires in", f"{max(0, time_remaining)} hours")
                         
                         # Download button
                         try:
-                            with open(file_info['filepath'], 'rb') as file:
-                                file_data = file.read()
-                            
-                            st.download_button(
-                                label="📥 Download File",
-                                data=file_data,
-                                file_name=file_info['filename'],
-                                mime=file_info['type'],
-                                type="primary",
-                                use_container_width=True
+                            mime = (
+                                file_info['type']
+                                or mimetypes.guess_type(file_info['filename'])[0]
+                                or "application/octet-stream"
                             )
                             
+                            # Passing the handle only saves the app's own read() copy; Streamlit
+                            # still reads the whole file into memory to serve it
+                            with open(file_info['filepath'], 'rb') as file:
+                                # Hint the kernel to read ahead aggressively for a whole-file read
+                                if hasattr(os, "posix_fadvise"):
+                                    with contextlib.suppress(OSError):
+                                        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                                st.download_button(
+                                    label="📥 Download File",
+                                    data=file,
+                                    file_name=file_info['filename'],
+                                    mime=mime,
+                                    type="primary",
+                                    use_container_width=True
+                                )
+                            
                         except Exception as e:
                             st.error(f"Error reading file: {str(e)}")
                             st.info("The file might have been corrupted or is no longer accessible.")
@@ -255,10 +378,7 @@ with tab2:
                         st.error("❌ File not found on disk.")
                         st.info("The file may have been moved or deleted from storage.")
                         # Clean up metadata for missing file
-                        metadata = load_file_metadata()
-                        if pin_input in metadata:
-                            del metadata[pin_input]
-                            save_file_metadata(metadata)
+                        delete_pin_metadata(pin_input)
                 else:
                     st.error("❌ Invalid PIN or file has expired.")
                     st.info("Please check the PIN or contact the file sender.")
@@ -269,43 +389,12 @@ with tab2:
 with tab3:
     st.header("How It Works")
     
+    senders_md, recipients_md = how_it_works_markdown()
     col1, col2 = st.columns(2)
-    
     with col1:
-        st.subheader("🚀 For Senders")
-        st.markdown("""
-        1. **Upload**: Select and upload your file
-        2. **Generate**: Click to generate a secure 4-digit PIN
-        3. **Share**: Send the PIN to your recipient
-        4. **Secure**: File expires automatically in 24 hours
-        """)
-        
-        st.subheader("🔒 Security Features")
-        st.markdown("""
-        - Random 4-digit PIN generation
-        - 24-hour automatic expiration
-        - Persistent secure file storage
-        - Automatic cleanup of expired files
-        - Unique PIN guarantee
-        """)
-    
+        st.markdown(senders_md)
     with col2:
-        st.subheader("📱 For Recipients")
-        st.markdown("""
-        1. **Receive**: Get the 4-digit PIN from sender
-        2. **Enter**: Input PIN in the Download tab
-        3. **Verify**: System verifies PIN and shows file info
-        4. **Download**: Click to download the file
-        """)
-        
-        st.subheader("⚠️ Important Notes")
-        st.markdown("""
-        - Files expire after 24 hours
-        - PINs are 4-digit numbers only
-        - Keep PINs confidential and secure
-        - Files are stored temporarily and auto-cleaned
-        - Each PIN is unique and cannot be reused
-        """)
+        st.markdown(recipients_md)
 
 # Footer
 st.markdown("---")
@@ -317,10 +406,17 @@ with col2:
     )
 
 # Display active transfers (for debugging/admin purposes)
-metadata = load_file_metadata()
-if metadata:
+total_transfers = count_active_transfers()
+if total_transfers:
     with st.expander("📊 Active Transfers (Admin View)", expanded=False):
-        st.write(f"Total active transfers: {len(metadata)}")
+        st.write(f"Total active transfers: {total_transfers}")
+        page_count = (total_transfers + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE
+        page = 1
+        if page_count > 1:
+            page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1)
+        
+        now = time.time()
+        metadata = load_file_metadata(limit=ADMIN_PAGE_SIZE, offset=(page - 1) * ADMIN_PAGE_SIZE)
         for pin, info in metadata.items():
             col1, col2, col3, col4 = st.columns(4)
             with col1:
@@ -330,7 +426,7 @@ if metadata:
             with col3:
                 st.text(f"Size: {info['size']/1024:.1f} KB")
             with col4:
-                hours_left = 24 - int((datetime.now() - info['upload_time']).total_seconds() / 3600)
+                hours_left = 24 - int((now - info['upload_time']) / 3600)
                 st.text(f"Expires: {max(0, hours_left)}h")
 else:
     with st.expander("📊 Active Transfers (Admin View)", expanded=False):